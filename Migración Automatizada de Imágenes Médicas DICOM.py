@@ -4,6 +4,9 @@ import time
 import threading
 import argparse
 import sys
+import json
+import math
+from concurrent.futures import ThreadPoolExecutor
 
 
 from pydicom.dataset import Dataset
@@ -43,6 +46,32 @@ DCM4CHEE_PORT = 11112
 LOCAL_AET = 'RADIANT'
 LOCAL_PORT = 11114
 
+# configuracion de ventanas de transferencia (limite de bytes/segundo)
+# el limite se aplica una sola vez por imagen: cada imagen se recibe de DCM4CHEE y se
+# reenvia a Orthanc en el mismo hilo, asi que limita a ambos peers a la vez
+# formato: (hora_inicio, hora_fin, bytes_por_segundo) -> None = sin limite (0 o negativo no es valido)
+# las ventanas que cruzan medianoche se expresan con hora_fin < hora_inicio
+# hora_inicio == hora_fin es una ventana de 24 horas
+TRANSFER_WINDOWS = [
+    ('07:00', '19:00', 2 * 1024 * 1024),  # horario de clinica: limitado
+    ('19:00', '07:00', None),             # noche: velocidad completa
+]
+
+# rafaga maxima permitida por el token bucket (en segundos de transferencia)
+TOKEN_BUCKET_BURST_SECONDS = 2
+
+# tamaño estimado por instancia para ordenar estudios (NumberOfStudyRelatedInstances)
+ESTIMATED_BYTES_PER_INSTANCE = 10 * 1024 * 1024
+
+# espera despues de cada C-GET para que terminen de reenviarse las imagenes
+STUDY_WAIT_SECONDS = 10
+
+# configuracion del modo --plan (C-FIND de SERIES/IMAGE en lotes y en paralelo)
+PLAN_BATCH_SIZE = 20          # estudios consultados por asociacion
+PLAN_CONCURRENCY = 4          # asociaciones C-FIND simultaneas
+PLAN_BATCH_RETRIES = 1        # reintentos de los estudios cuyo lote fallo
+PLAN_FILE = 'plan.json'
+
 # Configuracion mejorada de logging (log de las transacciones realizadas)
 logging.basicConfig(
     filename='log.txt',
@@ -51,13 +80,168 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+class TokenBucket:
+    """Limita la tasa de bytes/segundo de la transferencia (permite deuda y espera)"""
+    def __init__(self, rate=None, burst_seconds=TOKEN_BUCKET_BURST_SECONDS):
+        self.rate = None
+        self.burst_seconds = burst_seconds
+        self.capacity = 0
+        self.tokens = 0
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        """Cambia la tasa del bucket (None = sin limite)"""
+        with self.lock:
+            if rate == self.rate:
+                return
+            self.rate = rate
+            self.capacity = rate * self.burst_seconds if rate is not None else 0
+            self.tokens = min(self.tokens, self.capacity)
+            self.last_refill = time.monotonic()
+
+    def consume(self, nbytes):
+        """Consume nbytes del bucket, esperando si no hay tokens suficientes"""
+        with self.lock:
+            if self.rate is None:
+                return 0
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            # se permite deuda: el siguiente consumo espera a que se pague
+            self.tokens -= nbytes
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class TransferScheduler:
+    """Planifica la transferencia segun ventanas horarias y limita los bytes/segundo transferidos"""
+    def __init__(self, windows=None):
+        self.windows = []
+        for start, end, rate in (windows if windows is not None else TRANSFER_WINDOWS):
+            # 0 no significa pausa: se rechaza para no terminar transfiriendo sin limite
+            if rate is not None and rate <= 0:
+                raise ValueError(f"Limite invalido para la ventana {start}-{end}: {rate} (use None para sin limite)")
+            self.windows.append((self._parse_time(start), self._parse_time(end), rate))
+        self.bucket = TokenBucket()
+        self.lock = threading.Lock()
+        # segundos acumulados esperando al token bucket (se descuentan del throughput medido)
+        self.throttle_wait = 0
+        # throughput medido (bytes/segundo) de los estudios ya transferidos, sin esperas del limite
+        self.measured_rate = None
+
+    @staticmethod
+    def _parse_time(value):
+        """Convierte 'HH:MM' a minutos desde medianoche"""
+        hours, minutes = value.split(':')
+        return int(hours) * 60 + int(minutes)
+
+    def current_window(self, now=None):
+        """Retorna (bytes_por_segundo, segundos restantes) de la ventana vigente"""
+        if now is None:
+            now = datetime.datetime.now()
+        minute = now.hour * 60 + now.minute
+        seconds = minute * 60 + now.second
+
+        for start, end, rate in self.windows:
+            if start == end:
+                # ventana de 24 horas (p.ej. '00:00'-'00:00')
+                inside = True
+            elif start < end:
+                inside = start <= minute < end
+            else:
+                # ventana que cruza medianoche
+                inside = minute >= start or minute < end
+            if inside:
+                remaining = (end * 60 - seconds) % (24 * 3600)
+                return rate, remaining or 24 * 3600
+
+        # fuera de toda ventana configurada: sin limite hasta el proximo cambio
+        return None, None
+
+    def throttle(self, nbytes):
+        """Aplica el limite de la ventana vigente a nbytes transferidos"""
+        rate, _ = self.current_window()
+        self.bucket.set_rate(rate)
+        wait = self.bucket.consume(nbytes)
+        with self.lock:
+            self.throttle_wait += wait
+        if wait > 1:
+            logger.info(f"=======> Limite de transferencia: esperando {wait:.1f}s")
+        return wait
+
+    def record_transfer(self, nbytes, seconds):
+        """Actualiza el throughput medido con el resultado de un estudio transferido"""
+        if nbytes <= 0 or seconds <= 0:
+            return
+        rate = nbytes / seconds
+        # promedio movil para suavizar estudios atipicos
+        self.measured_rate = rate if self.measured_rate is None else 0.7 * self.measured_rate + 0.3 * rate
+
+    def effective_rate(self, rate):
+        """Tasa esperada: el menor entre el limite de la ventana y el throughput medido"""
+        if rate is None:
+            return self.measured_rate
+        if self.measured_rate is None:
+            return rate
+        return min(rate, self.measured_rate)
+
+    @staticmethod
+    def estimated_bytes(study):
+        """Estima el tamaño de un estudio (bytes del plan o NumberOfStudyRelatedInstances)"""
+        return study.get('bytes') or study.get('instances', 0) * ESTIMATED_BYTES_PER_INSTANCE
+
+    def estimate_duration(self, nbytes, throughput, now=None):
+        """Estima los segundos para transferir nbytes a un throughput dado respetando las ventanas"""
+        if now is None:
+            now = datetime.datetime.now()
+        elapsed = 0
+        while nbytes > 0:
+            rate, remaining = self.current_window(now)
+            rate = min(rate, throughput) if rate is not None else throughput
+            if remaining is None or nbytes / rate <= remaining:
+                return elapsed + nbytes / rate
+            nbytes -= rate * remaining
+            elapsed += remaining
+            now += datetime.timedelta(seconds=remaining)
+        return elapsed
+
+    def next_study(self, pending):
+        """Retira de pending el estudio mas grande que alcanza a terminar en la ventana actual
+
+        Si ninguno alcanza, retorna el mas pequeño (el limite de la siguiente ventana se
+        aplica igual imagen por imagen)
+        """
+        if not pending:
+            return None
+
+        rate, remaining = self.current_window()
+        rate = self.effective_rate(rate)
+        by_size = sorted(pending, key=self.estimated_bytes, reverse=True)
+
+        chosen = by_size[-1]
+        for study in by_size:
+            if rate is None or remaining is None or self.estimated_bytes(study) / rate <= remaining:
+                chosen = study
+                break
+
+        pending.remove(chosen)
+        return chosen
+
+
 class DicomRetrievalService:
     def __init__(self):
         self.scp_ae = None
         self.scp_thread = None
         self.images_received = 0
         self.images_forwarded = 0
-        
+        self.bytes_received = 0
+        self.scheduler = TransferScheduler()
+
     def get_critical_storage_contexts(self):
         """Retorna solo los contextos mas criticos para evitar el limite"""
         # CONTEXTOS CRiTICOS EN ORDEN DE PRIORIDAD
@@ -321,6 +505,12 @@ class DicomRetrievalService:
             sop_class = ds.get('SOPClassUID', 'Unknown')
             logger.info(f"===============================> Imagen #{self.images_received} recibida - SOP Class: {sop_class}")
             
+            nbytes = len(event.request.DataSet.getvalue())
+            self.bytes_received += nbytes
+            
+            # Aplicar limite de la ventana horaria (bloquear el handler frena tambien el C-GET)
+            self.scheduler.throttle(nbytes)
+            
             # Reenvia a Orthanc
             forward_ae = AE()
             forward_ae.add_requested_context(event.context.abstract_syntax)
@@ -400,6 +590,7 @@ class DicomRetrievalService:
         find_ds.PatientID = ''
         find_ds.AccessionNumber = ''
         find_ds.StudyDescription = ''
+        find_ds.NumberOfStudyRelatedInstances = ''
         
         ae = AE()
         # Agregamos contexto para busqueda
@@ -421,15 +612,21 @@ class DicomRetrievalService:
                         patient_name = getattr(identifier, 'PatientName', 'N/A')
                         patient_id = getattr(identifier, 'PatientID', 'N/A')
                         study_desc = getattr(identifier, 'StudyDescription', 'N/A')
+                        try:
+                            instances = int(getattr(identifier, 'NumberOfStudyRelatedInstances', 0) or 0)
+                        except (TypeError, ValueError):
+                            instances = 0
                         
                         studies.append({
                             'uid': study_uid,
                             'patient_name': patient_name,
                             'patient_id': patient_id,
-                            'description': study_desc
+                            'description': study_desc,
+                            'date': str(getattr(identifier, 'StudyDate', study_date)),
+                            'instances': instances
                         })
                         
-                        logger.info(f"=======> Estudio encontrado: {patient_name} ({patient_id}) - {study_desc}")
+                        logger.info(f"=======> Estudio encontrado: {patient_name} ({patient_id}) - {study_desc} - {instances} instancias")
                 
                 assoc.release()
                 logger.info(f"=======> Se encontraron {len(studies)} estudios")
@@ -562,8 +759,290 @@ class DicomRetrievalService:
             return False
 
     
-    def run_retrieval(self, study_date=None):
-        """Ejecuta el proceso completo de recuperación con optimizaciones"""
+    @staticmethod
+    def estimate_instance_bytes(identifier):
+        """Estima el tamaño de una instancia a partir de los atributos de imagen del C-FIND"""
+        try:
+            rows = int(getattr(identifier, 'Rows', 0) or 0)
+            columns = int(getattr(identifier, 'Columns', 0) or 0)
+            bits = int(getattr(identifier, 'BitsAllocated', 0) or 0)
+            samples = int(getattr(identifier, 'SamplesPerPixel', 1) or 1)
+            frames = int(getattr(identifier, 'NumberOfFrames', 1) or 1)
+        except (TypeError, ValueError):
+            return ESTIMATED_BYTES_PER_INSTANCE
+        
+        if not (rows and columns and bits):
+            return ESTIMATED_BYTES_PER_INSTANCE
+        return rows * columns * math.ceil(bits / 8) * samples * frames
+    
+    def find_series_batch(self, studies):
+        """Consulta SERIES e IMAGE de un lote de estudios reutilizando una sola asociacion"""
+        ae = AE(ae_title=LOCAL_AET)
+        ae.add_requested_context(StudyRootQueryRetrieveInformationModelFind)
+        
+        results = {}
+        
+        try:
+            assoc = ae.associate(DCM4CHEE_IP, DCM4CHEE_PORT, ae_title=DCM4CHEE_AET)
+            
+            if not assoc.is_established:
+                logger.error("=======> No se pudo establecer conexión con DCM4CHEE para FIND de series")
+                return results
+            
+            for study in studies:
+                series_ds = Dataset()
+                series_ds.QueryRetrieveLevel = 'SERIES'
+                series_ds.StudyInstanceUID = study['uid']
+                series_ds.SeriesInstanceUID = ''
+                series_ds.Modality = ''
+                series_ds.NumberOfSeriesRelatedInstances = ''
+                
+                series_list = []
+                for status, identifier in assoc.send_c_find(series_ds, StudyRootQueryRetrieveInformationModelFind):
+                    if status and status.Status in (0xFF00, 0xFF01):
+                        try:
+                            reported = int(getattr(identifier, 'NumberOfSeriesRelatedInstances', 0) or 0)
+                        except (TypeError, ValueError):
+                            reported = 0
+                        series_list.append({
+                            'uid': str(identifier.SeriesInstanceUID),
+                            'modality': str(getattr(identifier, 'Modality', '') or 'N/A'),
+                            'instances': 0,
+                            'bytes': 0,
+                            'reported_instances': reported,
+                            'estimated': False
+                        })
+                
+                # Nivel IMAGE: cuenta instancias y estima bytes por dimensiones de imagen
+                for series in series_list:
+                    image_ds = Dataset()
+                    image_ds.QueryRetrieveLevel = 'IMAGE'
+                    image_ds.StudyInstanceUID = study['uid']
+                    image_ds.SeriesInstanceUID = series['uid']
+                    image_ds.SOPInstanceUID = ''
+                    image_ds.Rows = ''
+                    image_ds.Columns = ''
+                    image_ds.BitsAllocated = ''
+                    image_ds.SamplesPerPixel = ''
+                    image_ds.NumberOfFrames = ''
+                    
+                    for status, identifier in assoc.send_c_find(image_ds, StudyRootQueryRetrieveInformationModelFind):
+                        if status and status.Status in (0xFF00, 0xFF01):
+                            series['instances'] += 1
+                            series['bytes'] += self.estimate_instance_bytes(identifier)
+                    
+                    # dcm4chee 1.x a veces no responde a nivel IMAGE: se usa el conteo de la serie
+                    if not series['instances']:
+                        series['instances'] = series['reported_instances']
+                        series['bytes'] = series['instances'] * ESTIMATED_BYTES_PER_INSTANCE
+                        series['estimated'] = True
+                
+                results[study['uid']] = series_list
+            
+            assoc.release()
+            
+        except Exception as e:
+            logger.error(f"=======> Error en find_series_batch: {e}")
+        
+        return results
+    
+    def calibrate_throughput(self, studies):
+        """Mide el throughput migrando el estudio mas pequeño (C-GET + reenvio a Orthanc)
+
+        El estudio se migra de verdad para que la medicion incluya el C-STORE hacia Orthanc
+        (queda marcado como 'migrated' en el plan); el limite de la ventana vigente se aplica
+        y sus esperas se descuentan de la medicion
+        """
+        candidates = [study for study in studies if study.get('instances', 0) > 0]
+        if not candidates:
+            logger.warning("=======> No hay estudios con instancias para calibrar el throughput")
+            return None
+        
+        study = min(candidates, key=lambda study: study.get('bytes') or study['instances'])
+        logger.info(f"=======> Calibrando throughput migrando el estudio {study['uid']} ({study['instances']} instancias) a Orthanc")
+        
+        initial_bytes = self.bytes_received
+        initial_wait = self.scheduler.throttle_wait
+        start_time = time.monotonic()
+        self.retrieve_study_optimized(study['uid'])
+        elapsed = time.monotonic() - start_time - (self.scheduler.throttle_wait - initial_wait)
+        nbytes = self.bytes_received - initial_bytes
+        
+        if nbytes <= 0 or elapsed <= 0:
+            logger.warning("=======> La transferencia de calibracion no recibio imágenes")
+            return None
+        
+        study['migrated'] = True
+        
+        throughput = nbytes / elapsed
+        logger.info(f"=======> Throughput medido: {throughput / (1024 * 1024):.2f} MB/s ({nbytes} bytes en {elapsed:.1f}s)")
+        return throughput
+    
+    def plan_migration(self, study_date, concurrency=1):
+        """Dimensiona la migracion (estudios, series, instancias, bytes) y estima su duracion
+
+        La ejecucion (run_retrieval) es secuencial: con concurrency > 1 la estimacion es hipotetica
+        """
+        logger.info(f"!!!!!!!!!!!!!!!!!!!!-------------------  Planificando migracion para fecha: {study_date} -------------------!!!!!!!!!!!!!!!!!!!!\n\n\n")
+        
+        studies = self.find_studies(study_date)
+        
+        # Excluir estudios ya existentes en Orthanc (run_retrieval tambien los omite)
+        uids_orthanc = {study['uid'] for study in self.find_studies_Orthanc(study_date)}
+        already_migrated = len([study for study in studies if study['uid'] in uids_orthanc])
+        studies = [study for study in studies if study['uid'] not in uids_orthanc]
+        if already_migrated:
+            logger.info(f"=======> {already_migrated} estudios ya existen en Orthanc y no se incluyen en el plan")
+        
+        # Consultas SERIES/IMAGE en lotes, cada lote en su propia asociacion
+        series_by_study = {}
+        pending = studies
+        for attempt in range(PLAN_BATCH_RETRIES + 1):
+            if attempt:
+                logger.warning(f"=======> Reintentando consulta de series para {len(pending)} estudios (intento {attempt})")
+            batches = [pending[i:i + PLAN_BATCH_SIZE] for i in range(0, len(pending), PLAN_BATCH_SIZE)]
+            with ThreadPoolExecutor(max_workers=PLAN_CONCURRENCY) as executor:
+                for results in executor.map(self.find_series_batch, batches):
+                    series_by_study.update(results)
+            pending = [study for study in studies if study['uid'] not in series_by_study]
+            if not pending:
+                break
+        
+        if pending:
+            logger.warning(f"=======> {len(pending)} estudios sin detalle de series por error de consulta: se estiman con "
+                           f"NumberOfStudyRelatedInstances y quedan marcados como 'estimated' en el plan")
+        
+        by_day = {}
+        by_modality = {}
+        plan_studies = []
+        for study in studies:
+            series_list = series_by_study.get(study['uid'], [])
+            instances = sum(series['instances'] for series in series_list)
+            nbytes = sum(series['bytes'] for series in series_list)
+            estimated = (study['uid'] not in series_by_study
+                         or any(series['estimated'] for series in series_list))
+            
+            # ultimo recurso: sin conteos de series se usa NumberOfStudyRelatedInstances
+            fallback = not instances
+            if fallback:
+                instances = study['instances']
+                nbytes = instances * ESTIMATED_BYTES_PER_INSTANCE
+                estimated = True
+            
+            plan_studies.append({
+                'uid': str(study['uid']),
+                'patient_name': str(study['patient_name']),
+                'patient_id': str(study['patient_id']),
+                'description': str(study['description']),
+                'date': study['date'],
+                'instances': instances,
+                'bytes': nbytes,
+                'estimated': estimated,
+                'migrated': False,
+                'series': series_list
+            })
+            
+            day = by_day.setdefault(study['date'], {'studies': 0, 'series': 0, 'instances': 0, 'bytes': 0})
+            day['studies'] += 1
+            day['series'] += len(series_list)
+            day['instances'] += instances
+            day['bytes'] += nbytes
+            
+            modalities = {series['modality'] for series in series_list}
+            if fallback:
+                # los conteos del estudio van a su unica modalidad conocida o a 'N/A'
+                modality = modalities.pop() if len(modalities) == 1 else 'N/A'
+                totals = by_modality.setdefault(modality, {'studies': 0, 'series': 0, 'instances': 0, 'bytes': 0})
+                totals['studies'] += 1
+                totals['series'] += len(series_list)
+                totals['instances'] += instances
+                totals['bytes'] += nbytes
+                continue
+            
+            for modality in modalities:
+                by_modality.setdefault(modality, {'studies': 0, 'series': 0, 'instances': 0, 'bytes': 0})['studies'] += 1
+            for series in series_list:
+                totals = by_modality[series['modality']]
+                totals['series'] += 1
+                totals['instances'] += series['instances']
+                totals['bytes'] += series['bytes']
+        
+        total_bytes = sum(study['bytes'] for study in plan_studies)
+        total_instances = sum(study['instances'] for study in plan_studies)
+        
+        # Estimacion de duracion: throughput medido x concurrencia, limitado por las ventanas horarias
+        # (run_retrieval es secuencial, con concurrency > 1 es solo una proyeccion)
+        # el estudio migrado durante la calibracion no cuenta para el tiempo restante
+        throughput = self.calibrate_throughput(plan_studies)
+        remaining = [study for study in plan_studies if not study['migrated']]
+        estimated_seconds = None
+        if concurrency > 1:
+            logger.warning(f"=======> La ejecucion es secuencial: la estimacion con concurrencia {concurrency} es hipotetica")
+        if throughput:
+            estimated_seconds = (
+                self.scheduler.estimate_duration(sum(study['bytes'] for study in remaining), throughput * concurrency)
+                + len(remaining) * STUDY_WAIT_SECONDS / concurrency
+            )
+        
+        plan = {
+            'study_date': study_date,
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'concurrency': concurrency,
+            'estimate_hypothetical': concurrency > 1,
+            'totals': {
+                'studies': len(plan_studies),
+                'estimated_studies': sum(study['estimated'] for study in plan_studies),
+                'already_in_orthanc': already_migrated,
+                'migrated_by_calibration': len(plan_studies) - len(remaining),
+                'series': sum(len(study['series']) for study in plan_studies),
+                'instances': total_instances,
+                'bytes': total_bytes
+            },
+            'by_day': by_day,
+            'by_modality': by_modality,
+            'throughput_bytes_per_second': throughput,
+            'estimated_seconds': estimated_seconds,
+            'studies': plan_studies
+        }
+        
+        logger.info(f"=======> Plan: {len(plan_studies)} estudios ({plan['totals']['estimated_studies']} estimados), "
+                    f"{plan['totals']['series']} series, {total_instances} instancias, {total_bytes / (1024 ** 3):.2f} GB")
+        for day, totals in sorted(by_day.items()):
+            logger.info(f"=======>   {day}: {totals['studies']} estudios, {totals['series']} series, "
+                        f"{totals['instances']} instancias, {totals['bytes'] / (1024 ** 2):.1f} MB")
+        for modality, totals in sorted(by_modality.items()):
+            logger.info(f"=======>   {modality}: {totals['studies']} estudios, {totals['series']} series, "
+                        f"{totals['instances']} instancias, {totals['bytes'] / (1024 ** 2):.1f} MB")
+        if estimated_seconds is not None:
+            logger.info(f"=======> Duracion estimada con concurrencia {concurrency}"
+                        f"{' (hipotetica)' if concurrency > 1 else ''}: "
+                        f"{datetime.timedelta(seconds=int(estimated_seconds))}")
+        
+        return plan
+    
+    @staticmethod
+    def save_plan(plan, path=PLAN_FILE):
+        """Guarda el plan en un archivo JSON"""
+        with open(path, 'w', encoding='utf-8') as plan_file:
+            json.dump(plan, plan_file, indent=2, ensure_ascii=False)
+        logger.info(f"=======> Plan guardado en {path}")
+    
+    @staticmethod
+    def load_plan(path=PLAN_FILE):
+        """Carga un plan generado con --plan"""
+        with open(path, encoding='utf-8') as plan_file:
+            plan = json.load(plan_file)
+        logger.info(f"=======> Plan cargado desde {path}: {len(plan['studies'])} estudios")
+        return plan
+    
+    def run_retrieval(self, study_date=None, plan=None):
+        """Ejecuta el proceso completo de recuperación con optimizaciones (opcionalmente desde un plan)"""
+        if plan:
+            study_date = plan['study_date']
+            # el throughput calibrado en el plan sirve de punto de partida al planificador
+            if plan.get('throughput_bytes_per_second'):
+                self.scheduler.measured_rate = plan['throughput_bytes_per_second']
+        
         if not study_date:
             study_date = datetime.date.today().strftime('%Y%m%d') #formato para la fecha actual
         
@@ -584,8 +1063,11 @@ class DicomRetrievalService:
         
         
         try:
-            # 4. Buscar estudios servidor hcm3chee
-            studies = self.find_studies(study_date)
+            # 4. Buscar estudios servidor hcm3chee (con plan cargado no se vuelve a consultar)
+            if plan:
+                studies = [study for study in plan['studies'] if not study.get('migrated')]
+            else:
+                studies = self.find_studies(study_date)
             
             # Buscar estudios servidor Orthanc para solo procesar los validos
             studies_orthanc = self.find_studies_Orthanc(study_date)
@@ -597,8 +1079,9 @@ class DicomRetrievalService:
             # exluimos estudios ya existentes en orthanc
             if len(studies_orthanc)>0:
                 #buscamos el uid en la lista de studies de dcm4chee y eliminamos el registro
+                uids_orthanc = {study['uid'] for study in studies_orthanc}
                 studies = [study for study in studies 
-                           if study not in studies_orthanc]
+                           if study['uid'] not in uids_orthanc]
 
             if not studies:
                 logger.info("=======> No se encontraron estudios no existentes en el servidor Orthanc para la fecha especificada")
@@ -611,15 +1094,26 @@ class DicomRetrievalService:
             
             
             # 6. Procesar los estudios (debug)
+            # el planificador elige el siguiente estudio segun su tamaño y la ventana horaria vigente
             logger.info(f"\n\n\n!!!!!!!!!!!!!!!!!!!!------------------- Procesando {len(studies)} estudios -------------------!!!!!!!!!!!!!!!!!!!!")
-            for i, study in enumerate(studies, start=1):
-                logger.info(f"=======> Procesando estudio {i}/{len(studies)} - UID: {study['uid']}")
+            pending = list(studies)
+            i = 0
+            while pending:
+                study = self.scheduler.next_study(pending)
+                i += 1
+                logger.info(f"=======> Procesando estudio {i}/{len(studies)} - UID: {study['uid']} ({study.get('instances', 0)} instancias)")
                 initial_count = self.images_received
+                initial_bytes = self.bytes_received
+                initial_wait = self.scheduler.throttle_wait
+                start_time = time.monotonic()
 
                 success = self.retrieve_study_optimized(study['uid'])
+                # throughput sin las esperas del limite, para no arrastrar el limite diurno a la noche
+                elapsed = time.monotonic() - start_time - (self.scheduler.throttle_wait - initial_wait)
+                self.scheduler.record_transfer(self.bytes_received - initial_bytes, elapsed)
 
                 logger.info("=======> Esperando procesamiento de imágenes...\n\n")
-                time.sleep(10)  # Puedes ajustar este valor si sabes que tarda más/menos
+                time.sleep(STUDY_WAIT_SECONDS)  # Puedes ajustar este valor si sabes que tarda más/menos
 
                 images_for_this_study = self.images_received - initial_count
                 logger.info(f"=======> Estudio {i}: {images_for_this_study} imágenes recibidas")
@@ -655,10 +1149,35 @@ def main():
     logger.info(f"!!!!!!!!!!!!!!!!!!!!-------------------Fecha de ejecucion: {Fch_ejecucion} {Hora_ejecucion} -------------------!!!!!!!!!!!!!!!!!!!!")
     logger.info(f"!!!!!!!!!!!!!!!!!!!!----------------------------------------------------------------------------!!!!!!!!!!!!!!!!!!!!\n\n\n")
 
+    parser = argparse.ArgumentParser(description='Migracion de estudios DICOM de DCM4CHEE a Orthanc')
+    parser.add_argument('--date', help='Fecha de estudio YYYYMMDD o rango YYYYMMDD-YYYYMMDD (por defecto hoy)')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--plan', action='store_true',
+                      help='Dimensiona y estima la migracion (solo migra el estudio mas pequeño para calibrar)')
+    mode.add_argument('--load-plan', action='store_true', help='Ejecuta la migracion desde el archivo del plan')
+    parser.add_argument('--plan-file', default=PLAN_FILE, help=f'Archivo del plan (por defecto {PLAN_FILE})')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='Concurrencia para la estimacion de duracion; la ejecucion es secuencial, '
+                             'con valores > 1 la estimacion es hipotetica (por defecto 1)')
+    args = parser.parse_args()
+    
+    if args.load_plan and args.date:
+        parser.error('--date no se puede combinar con --load-plan (se usa la fecha guardada en el plan)')
+    if args.concurrency < 1:
+        parser.error('--concurrency debe ser mayor o igual a 1')
+    
+    study_date = args.date or datetime.date.today().strftime('%Y%m%d')
+
     service = DicomRetrievalService()
     
     try:
-        success = service.run_retrieval()
+        if args.plan:
+            plan = service.plan_migration(study_date, args.concurrency)
+            service.save_plan(plan, args.plan_file)
+            return
+        
+        plan = service.load_plan(args.plan_file) if args.load_plan else None
+        success = service.run_retrieval(study_date, plan)
         
         if success:
             logger.info("!!!!!!!!!!!!!!!!!!!!-------------------Proceso completado exitosamente-------------------!!!!!!!!!!!!!!!!!!!!")